@@ -1,18 +1,15 @@
 import pdfquery as pq
-import pandas as pd
-import xml.etree.ElementTree as ET
-from pprint import pprint
 import re
-import nltk
-from nltk.tokenize import RegexpTokenizer
-nltk.download('punkt')
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 class KudExtract:
 
-    number_pattern = re.compile(r'^(\d{1,3}(?:[.,]\d{3})*(?:[.,]\d{2})?)\s?([+-]?)$')
-    useless_tokens_pattern = re.compile(r'^\s*\+\s*$')
-    tokenizer = RegexpTokenizer(r'\w+')
-    date_pattern = re.compile(r'\d{2}\.\d{2}\s*$')
+    word_pattern = re.compile(r'\w+')
+    date_pattern = re.compile(r'\d{2}\.\d{2}')
+    page_tag = "LTPage"
+    line_tag = "LTTextLineHorizontal"
+    textbox_tag = "LTTextBoxHorizontal"
 
     def __init__(self, year, decimal_separator = ',', thousands_separator = '.'):
         self.year = year
@@ -24,299 +21,213 @@ class KudExtract:
         print(f"Processing Kontoudskrift {filepath} for year {self.year}")
 
         # Load PDF and generate XML
-        self.__load_pdf_contents(filepath)
+        tree = self.__load_pdf_contents(filepath)
 
-        # Extract lines
-        lines = self.__extract_lines("kud.xml")
-
-        print(f"Extracted {len(lines)} lines")
+        # Stream each line through cleaning and filtering as soon as it is extracted, creating the final list
+        num_lines = 0
+        data = []
 
-        # Clean up lines
-        lines = self.__clean_lines(lines)
+        for index, line in self.__extract_lines(tree): 
 
-        # Filter lines
-        lines = self.__filter_lines(lines)
+            num_lines += 1
 
-        # Remove tokens that are not needed
-        lines = self.__filter_tokens(lines)
+            item = self.__finalize_line(self.__clean_line(line))
 
-        print(f"Final lines retained: {len(lines)}")
+            if item is not None: 
+                data.append(item)
 
-        # Create the final list
-        data = self.__transform_to_json(lines)
+        print(f"Extracted {num_lines} lines")
+        print(f"Final lines retained: {len(data)}")
 
         return data
+
+    def process_pdfs(self, filepaths, max_workers = None): 
+        '''Processes multiple Kontoudskrift PDFs in parallel, each PDF in its own worker process
+
+        Parameters: 
+        filepaths (list): the paths of the PDFs to process
+        max_workers (int): the maximum number of worker processes. Defaults to the number of CPUs
+
+        Returns: 
+        list: for each PDF (in the same order as filepaths), the list of items extracted by process_pdf
+        '''
+        with ProcessPoolExecutor(max_workers=max_workers) as executor: 
+            return list(executor.map(self.process_pdf, filepaths))
     
     def __load_pdf_contents(self, filepath): 
         pdf = pq.PDFQuery(filepath)
         pdf.load()
-        pdf.tree.write('kud.xml', pretty_print=True)
 
-    def __extract_lines(self, xmlFilename): 
+        return pdf.tree
+
+    def __extract_lines(self, tree): 
         '''Extract all lines of text present in the XML (representing a PDF)
+        The lines of a page are yielded as soon as the page has been fully read, so that only one page at a time is kept in memory
         
         Parameters: 
-        xmlFilename (string): the file name of the xml to load. The XML is the PDF converted into XML.
+        tree (lxml.etree.ElementTree): the PDF converted into XML, as loaded by pdfquery.
 
-        Returns: 
-        dict: a dictionnary where the key is the identifier (page, line) (e.g. P1L670.11). Each element is a list of tokens belonging on the same line and page
-            Example of keys:
+        Yields: 
+        tuple: the identifier (page, line) (e.g. P1L670.11) and the list of tokens belonging on the same line and page
+            Example of lines:
             P1L503.007: ['Indestående ', 'Indsat ', 'Bogført ', 'Rente- ']
             P1L492.207: ['Gæld ', 'Hævet ', 'dato ', 'dato ']
             P1L468.447: ['494,42 - ', '3.291,68 ', '+ ', 'Gjensidige Forsikring, D ', '03.10 ', '03.10 ']
 
         '''
-        tree = ET.parse(xmlFilename)
-        root = tree.getroot()
+        page_lines = defaultdict(list)
 
-        lines = {}
+        # Single walk over the tree: pages come before the lines they contain (document order)
+        for element in tree.iter(self.page_tag, self.line_tag): 
 
-        pages = root.findall(".//LTPage")
+            if element.tag == self.page_tag: 
+                # A new page starts: the lines of the previous page are complete
+                yield from page_lines.items()
 
-        for page in pages: 
-            page_num = int(page.get("pageid"))
+                page_lines = defaultdict(list)
+                page_num = int(element.get("pageid"))
+                continue
             
-            for line in page.findall(".//LTTextLineHorizontal"):
-                y0 = float(line.get("y0"))
-                index = "P" + str(page_num) + "L" + str(y0)
+            y0 = float(element.get("y0"))
+            index = f"P{page_num}L{y0}"
 
-                text_element = line.text or line.find(".//LTTextBoxHorizontal").text
+            text_element = element.text
 
-                if index in lines: 
-                    lines[index].append(text_element)
-                else: 
-                    lines[index] = [text_element]
+            if text_element is None: 
+                textbox = element.find(self.textbox_tag)
+                text_element = (textbox.text or "") if textbox is not None else ""
 
-        return lines;
+            page_lines[index].append(text_element)
+
+        yield from page_lines.items()
     
-    def __parse_numbers(self, line): 
-        '''Cleans the numbers contained in a given line.
-        Cleaning up numbers means moving from '494,42 - ' to a float -494.42
+    def __parse_amount(self, token): 
+        '''Parses an amount, moving from '494,42 -' to a float -494.42
+        The amount has 1 to 3 digits, followed by groups of 3 digits and optionally 2 decimals, separated by '.' or ','.
+        It can be followed by a sign ('+' or '-'), optionally preceded by a space.
 
         Parameters: 
-        line (list): the list of tokens of the line
+        token (string): the stripped token
 
         Returns: 
-        list: the cleaned line
+        float: the amount, or None if the token is not an amount
         '''
-        clean_line = []
+        sign = token[-1:]
 
-        for token in line: 
+        if sign in ('+', '-'): 
+            token = token[:-1]
 
-            date_match = self.date_pattern.match(token.strip())
+            if token[-1:].isspace(): 
+                token = token[:-1]
 
-            if date_match:
-                clean_line.append(token)
-                continue
+        groups = token.replace(',', '.').split('.')
+        decimals = groups.pop() if len(groups) > 1 and len(groups[-1]) == 2 else ''
 
-            match = self.number_pattern.match(token.strip())
+        if not 1 <= len(groups[0]) <= 3 or any(len(group) != 3 for group in groups[1:]): 
+            return None
 
-            if match:
-                numeric_part, sign = match.groups()
-                numeric_part = numeric_part.replace(' ', '').replace(self.thousands_separator, '').replace(self.decimal_separator, '.')  # Replace comma with period for decimal part
-                number = float(numeric_part)
-                if sign == '-':
-                    number = -number
-                
-                clean_line.append(number)
-            else: 
-                clean_line.append(token)
+        if not (''.join(groups) + decimals).isdecimal(): 
+            return None
 
-        return clean_line
-    
-    def __remove_useless_tokens(self, line):
-        '''Removes tokens that are not needed.
-        That is, for example, tokens ' +'
+        try: 
+            number = float(token.replace(self.thousands_separator, '').replace(self.decimal_separator, '.'))  # Replace comma with period for decimal part
+        except ValueError: 
+            return None
 
-        Parameters: 
-        line (list): the line as a list of tokens
+        return -number if sign == '-' else number
 
-        Returns:
-        list: the clean line
-        '''
-        clean_line = []
-
-        for token in line: 
-
-            if isinstance(token, (int, float)): 
-                clean_line.append(token)
-                continue
-            
-            match = self.useless_tokens_pattern.match(token)
-
-            if not match: 
-                clean_line.append(token)
-
-
-        return clean_line
-    
-    def __clean_date(self, line): 
-        '''Cleans the date
+    def __clean_line(self, line): 
+        '''Cleans a line in a single pass over its tokens: 
+         - dates are trimmed
+         - numbers are parsed, moving from '494,42 - ' to a float -494.42
+         - useless tokens (e.g. ' +') are removed
+         - text is cleaned, only keeping words
 
         Parameters: 
-        line (list): the line as a list of tokens
+        line (list): the list of tokens of the line
 
-        Returns:
-        list: the clean line
+        Returns: 
+        list: the cleaned line. Numbers are floats, dates and text are tagged as ('date', token) and ('text', token)
         '''
         clean_line = []
 
-        for token in line: 
+        # Bind the methods once, rather than looking them up for every token
+        append = clean_line.append
+        is_date = self.date_pattern.fullmatch
+        parse_amount = self.__parse_amount
+        find_words = self.word_pattern.findall
 
-            if isinstance(token, (int, float)): 
-                clean_line.append(token)
-                continue
-
-            clean_line.append(token.strip())
-        
-        return clean_line
-    
-    def __clean_text(self, line): 
-        '''Cleans the text, only keeping words
+        for token in line: 
 
-        Parameters: 
-        line (list): the line as a list of tokens
+            token = token.strip()
 
-        Returns:
-        list: the clean line
-        '''
-        clean_line = []
+            # Dates are checked first, since they would otherwise be matched as numbers
+            if is_date(token):
+                append(('date', token))
+                continue
 
-        for token in line: 
+            number = parse_amount(token)
 
-            if isinstance(token, (int, float)): 
-                clean_line.append(token)
+            if number is not None:
+                append(number)
                 continue
 
-            if self.date_pattern.match(token):
-                clean_line.append(token)
+            # Useless tokens (e.g. ' +') are just a '+' once stripped
+            if token == '+': 
                 continue
 
-            text_tokens = self.tokenizer.tokenize(token)
+            text_tokens = find_words(token)
             clean_text = ' '.join(text_tokens)
 
-            clean_line.append(clean_text)
-        
-        return clean_line
-    
-
-    def __clean_lines(self, lines): 
-        '''Takes the lines and cleans up the numbers and the text
-        Cleaning up numbers means moving from '494,42 - ' to a float -494.42
-        Cleans up dates (e.g. trims)
-        '''
-
-        pattern = re.compile(r'^(\d{1,3}(?:\.\d{3})*(?:,\d{2})?)\s?([+-]?)$')
-
-        for key in lines.keys():
-
-            # Clean the numbers
-            lines[key] = self.__parse_numbers(lines[key])
-            
-            # Cleans dates
-            lines[key] = self.__clean_date(lines[key])
-
-            # Remove useless tokens
-            lines[key] = self.__remove_useless_tokens(lines[key])
+            append(('text', clean_text))
 
-            # Cleans the text description
-            lines[key] = self.__clean_text(lines[key])
+        return clean_line
 
-        return lines
-    
-    def __filter_lines(self, lines):
-        '''Filter the lines, keeping only the ones corresponding to payments
+    def __finalize_line(self, line):
+        '''Filters the line and transforms it into JSON (dict) in a single pass: 
+         - only the lines corresponding to payments (containing at least 2 numbers) are kept
+         - the saldo is removed, only keeping the smallest number as the amount
+         - duplicate tokens (e.g. dates) are removed
         
         Parameters: 
-        lines (dict): the dictionnary of lines
+        line (list): the cleaned line
 
         Returns: 
-        dict: the updated dictionnary
+        dict: a JSON with the key expense information, or None if the line is not a payment
         '''
-        clean_lines = {}    
-
-        for key, line in lines.items(): 
-
-            # Count how many numbers this line contains. 
-            # If the line contains >= 2 numbers, then it's a valid line, to keep
-            num_numbers = sum(isinstance(item, (int, float)) for item in line)
-
-            if num_numbers >= 2: 
-                clean_lines[key] = line
-        
-        return clean_lines
-    
-    def __filter_tokens(self, lines): 
-        '''Filter the tokens, keeping only the ones that are needed
-        Removes the saldo
-        Removes duplicate dates
-        
-        Parameters: 
-        lines (dict): the dictionnary of lines
+        num_numbers = 0
+        smallest_number = 10**20
+        date = '??.??'
+        text = 'TBD'
+        seen_tokens = set()
 
-        Returns: 
-        dict: the updated dictionnary
-        '''
-        clean_lines = {}    
-
-        for key, line in lines.items(): 
-
-            smallest_number = 10**20
-            clean_line = []
-
-            for token in line: 
-                
-                if isinstance(token, (int, float)): 
-                    if token < smallest_number: 
-                        smallest_number = token
-                    continue
-                
-                # Check that the token is not already in the list (eliminate duplicates)
-                if not token in clean_line: 
-                    clean_line.append(token)
+        for token in line: 
             
-            clean_line.append(smallest_number)
-
-            clean_lines[key] = clean_line
-        
-        return clean_lines
-
-    def __transform_to_json(self, lines):
-        '''Transforms the provided lines into JSON (dict)
-
-        Parameters: 
-        lines (dict): the dictionnary of lines
-
-        Returns: 
-        list: a list of items, each item being a JSON with the key expense information
-        '''
-        data = []
-
-        for line in lines.values(): 
-
-            amount = 0
-            date = '??.??'
-            text = 'TBD'
+            if type(token) is float: 
+                num_numbers += 1
+                if token < smallest_number: 
+                    smallest_number = token
+                continue
             
-            for token in line: 
-
-                if isinstance(token, (int, float)): 
-                    amount = token
-                    continue
+            # Only consider tokens that have not already been seen (eliminate duplicates)
+            if token in seen_tokens: 
+                continue
 
-                if self.date_pattern.match(token):
-                    date = token + "." + str(self.year)
-                    continue
+            seen_tokens.add(token)
 
-                text = token
-            
-            json = {
-                "date": date, 
-                "text": text, 
-                "amount": amount
-            }
+            token_type, value = token
 
-            data.append(json)
+            if token_type == 'date': 
+                date = value + "." + str(self.year)
+            else: 
+                text = value
         
-        return data
-    
+        # If the line contains < 2 numbers, then it's not a payment line
+        if num_numbers < 2: 
+            return None
+
+        return {
+            "date": date, 
+            "text": text, 
+            "amount": smallest_number
+        }